@@ -1,113 +1,1529 @@
+import asyncio
+import concurrent.futures
+import numpy as np
 import streamlit as st
+import httpx
 from openai import OpenAI
 from datetime import datetime
+import json
 import os
-from typing import Optional
+import re
+from typing import Iterator, Optional, Protocol
 import random
+import threading
+import time
+import hashlib
+import struct
 
-# Initialize OpenAI client
-client = OpenAI(api_key=st.secrets['OPENAI_API_KEY'])
+# Custom CSS for dark theme
+CSS = """
+    <style>
+    /* Main container styling */
+    .stApp {
+        background-color: #0e1117;
+    }
 
-def generate_lesson_plan_with_openai(
-    enquiry_question: str,
-    year_group: str,
-    num_lessons: int,
-    objectives: str,
-    active_learning: str,
-    adaptive_practices: str
-) -> Optional[str]:
-    """Generate a lesson plan using OpenAI's GPT model"""
-    prompt = f"""
-    As an expert educator, create a detailed lesson plan for primary school children in {year_group}.
-    Design a sequence of {num_lessons} lessons to address the enquiry question: "{enquiry_question}".
-    The lesson order has to be sequential, in order to build on the understanding of previous lessons.
     
-    Key Requirements:
-    1. Use Bloom's Taxonomy for learning objectives
-    2. Include active learning components
-    3. Incorporate adaptive teaching strategies
-    4. Ensure progression across lessons
+    /* Chat container */
+    .chat-container {
+        background-color: #1a1c23;
+        padding: 1rem;
+        border-radius: 8px;
+        margin: 1rem 0;
+        border: 1px solid #2d3139;
+    }
+    
+    /* Rest of the CSS remains the same */
+    </style>
+"""
+
+
+@st.cache_resource
+def inject_css() -> None:
+    """Render the page CSS; Streamlit replays the cached element on later reruns"""
+    st.markdown(CSS, unsafe_allow_html=True)
+
+
+OPENAI_API_BASE = "https://api.openai.com/v1"
+# Non-streamed calls send nothing until the whole completion is ready, so they get the SDK's
+# 600s read timeout; streamed calls only need to wait for the gap between chunks
+OPENAI_TIMEOUT = httpx.Timeout(600.0, connect=10.0)
+OPENAI_STREAM_TIMEOUT = httpx.Timeout(60.0, connect=10.0)
+# Embeddings only feed the semantic cache, so they give up quickly rather than delay generation
+EMBEDDING_TIMEOUT = httpx.Timeout(5.0, connect=3.0)
+EMBEDDING_MAX_RETRIES = 1
+# How long Generate waits for a prefetched embedding before skipping the semantic cache
+PREFETCH_WAIT_SECONDS = 3.0
+# Timeouts, conflicts, rate limits and server errors are retried with backoff, as the SDK did
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+MAX_RETRIES = 3
+
+
+@st.cache_resource
+def _openai_client() -> OpenAI:
+    """OpenAI SDK client shared across reruns and sessions, used for the Batch API.
+
+    Clients are created on first use rather than at import, so the module's pure helpers
+    can be imported (e.g. by the tests) without st.secrets.
+    """
+    return OpenAI(api_key=st.secrets['OPENAI_API_KEY'])
+
+@st.cache_resource
+def _http_client() -> httpx.Client:
+    """HTTP/2 client for direct chat and embedding requests from the script thread.
+
+    Calling the REST API directly skips the SDK's response model validation (retries are
+    handled by _send_with_retries); the shared connection also avoids a TLS handshake per request.
+    """
+    return httpx.Client(
+        http2=True,
+        base_url=OPENAI_API_BASE,
+        headers={"Authorization": f"Bearer {st.secrets['OPENAI_API_KEY']}"},
+        timeout=OPENAI_TIMEOUT
+    )
+
+@st.cache_resource
+def _async_http_client() -> httpx.AsyncClient:
+    """Async counterpart of _http_client; only used on the background event loop"""
+    return httpx.AsyncClient(
+        http2=True,
+        base_url=OPENAI_API_BASE,
+        headers={"Authorization": f"Bearer {st.secrets['OPENAI_API_KEY']}"},
+        timeout=OPENAI_TIMEOUT
+    )
+
+# Deterministic mode pins temperature to 0 so identical requests can be served from cache
+DETERMINISTIC_MODE = os.environ.get("LESSON_PLANNER_DETERMINISTIC", "").lower() in ("1", "true", "yes")
+
+# Initial generation needs the strongest model; refinements and chat are mostly small tweaks
+GENERATE_MODEL = "gpt-4-turbo-preview"
+REFINE_MODEL = "gpt-4o-mini"
+# Comments at least this long are treated as substantial rewrites and escalated to GENERATE_MODEL
+REFINE_ESCALATION_CHARS = 200
+
+# Output token ceilings; requesting less than the maximum shortens queueing on rate-limited keys
+MAX_OUTPUT_TOKENS = 4000
+TOKENS_PER_LESSON = 450
+# A lesson written on its own request repeats context a whole-plan lesson shares, so it gets more room
+LESSON_MAX_TOKENS = 1200
+
+# Semantic cache settings for near-duplicate enquiries
+EMBEDDING_MODEL = "text-embedding-3-small"
+SEMANTIC_CACHE_THRESHOLD = 0.92
+# Oldest entries are dropped beyond this so each partition stays a manageable size
+SEMANTIC_CACHE_MAX_ENTRIES = 500
+
+# Cached completions and each semantic cache entry expire a day after they are stored
+CACHE_TTL_SECONDS = 86400
+# Set ENABLE_PERSISTENT_CACHE=1 to keep caches on disk, or in Redis when REDIS_URL is in secrets
+ENABLE_PERSISTENT_CACHE = os.environ.get("ENABLE_PERSISTENT_CACHE", "").lower() in ("1", "true", "yes")
+PERSISTENT_CACHE_DIR = "/tmp/lesson_cache"
+# A cache is only worth waiting on briefly; an unreachable Redis counts as a miss after this
+REDIS_TIMEOUT_SECONDS = 1.5
+
+# Invariant instructions shared by every lesson planning call. They are sent first, as the
+# system message, so OpenAI's automatic prompt caching (prefixes of 1024+ tokens) applies
+# and only the short per-request fields that follow are billed and processed at full cost.
+STATIC_PREFIX = """You are an experienced educator with expertise in lesson planning for primary schools in England.
+You design sequences of lessons for children from Reception to Year 6, and you refine existing plans
+when teachers ask for changes. Follow every instruction below for every plan you write or revise.
+
+# Creating a lesson plan
+
+When you are given an enquiry question, a year group, a number of lessons, learning objectives,
+active learning activities and adaptive teaching practices, create a detailed lesson plan for primary
+school children in that year group. Design exactly the requested number of lessons to address the
+enquiry question. The lesson order has to be sequential, in order to build on the understanding of
+previous lessons.
+
+Key Requirements:
+1. Use Bloom's Taxonomy for learning objectives
+2. Include active learning components
+3. Incorporate adaptive teaching strategies
+4. Ensure progression across lessons
+
+Use the teacher's learning objectives, active learning activities and adaptive teaching practices as
+the starting point for the sequence. Weave them into the lessons where they fit best rather than
+repeating them verbatim in every lesson.
+
+# Refining a lesson plan
+
+When you are given a base lesson plan and the teacher's comments, refine the plan based on those
+comments. Keep everything the teacher has not asked to change, keep the same structure and headings,
+and make sure the sequence still builds progressively from one lesson to the next.
+
+# Lesson structure
+
+For each lesson, provide:
+1. Lesson Title & Learning Objective
+2. Key Vocabulary
+3. Main Activities (including timings)
+4. Differentiation Strategies
+5. Assessment Opportunities
+6. Resources Needed
+7. Home Learning Extensions
+
+Start each lesson with a level-two markdown heading of the form "## Lesson N: Title", numbering the
+lessons from 1. Timings for the main activities should add up to a realistic lesson length for the year
+group: around 30 to 40 minutes for Reception and Key Stage 1, and 45 to 60 minutes for Key Stage 2.
+
+# Bloom's Taxonomy rubric
+
+Write every learning objective with a measurable verb from one level of Bloom's Taxonomy, and choose
+the level deliberately. Early lessons in a sequence usually sit lower in the taxonomy and later lessons
+climb towards the higher levels as understanding secures.
+
+1. Remember - recall facts and basic concepts.
+   Verbs: define, list, name, recall, recognise, label, match, state.
+   Evidence: children can retrieve key vocabulary and facts without prompts.
+2. Understand - explain ideas or concepts.
+   Verbs: describe, explain, summarise, classify, compare, give examples of, retell.
+   Evidence: children can put an idea into their own words and sort examples from non-examples.
+3. Apply - use information in new situations.
+   Verbs: use, demonstrate, solve, carry out, show, calculate, measure.
+   Evidence: children can use a method or idea in a context they have not seen before.
+4. Analyse - draw connections among ideas.
+   Verbs: investigate, sort, distinguish, examine, question, test, identify patterns.
+   Evidence: children can break a problem into parts and explain how the parts relate.
+5. Evaluate - justify a stand or decision.
+   Verbs: judge, argue, justify, assess, decide, critique, recommend.
+   Evidence: children can give reasons for a choice and weigh up alternatives.
+6. Create - produce new or original work.
+   Verbs: design, compose, construct, plan, invent, produce, devise.
+   Evidence: children can combine what they have learned into something of their own.
+
+Avoid unmeasurable verbs such as "know", "understand" or "learn about" in objectives. Pitch the level
+to the year group: Reception and Year 1 objectives will mostly sit in the first three levels, while
+Years 5 and 6 should regularly reach analyse, evaluate and create.
+
+# Active learning
+
+Active learning means children are doing the thinking. Favour talk partners, think-pair-share,
+practical investigation, hands-on manipulatives, role play, drama, games, movement, sorting and
+ranking tasks, mini whiteboards, and collaborative problem solving over long teacher explanations.
+Keep teacher input short and break it up with regular opportunities for children to respond.
+
+# Adaptive teaching
+
+Adaptive teaching means planning so that every child can reach the objective, not planning different
+objectives for different children. Include scaffolds such as sentence stems, word banks, worked
+examples, visual prompts, concrete resources and pre-teaching of vocabulary for children who need
+support. Include stretch through deeper questions, open-ended challenges and opportunities to explain
+reasoning for children who are ready. Mention how adults in the room will be deployed, and how the
+lesson supports children with special educational needs and those learning English as an additional
+language.
+
+# Assessment
+
+Plan assessment for learning into every lesson: hinge questions, exit tickets, observation of
+talk and practical work, self and peer assessment against the objective, and a short retrieval task at
+the start of each lesson that revisits the previous lesson. The final lesson in a sequence should give
+children a chance to answer the enquiry question and show what they have learned.
+
+# Formatting
+
+Format the output using markdown for clear structure. Use headings for lessons and bold labels or
+sub-headings for the seven sections of each lesson. Use bulleted lists for vocabulary, resources and
+activities, and keep the language clear enough for a busy teacher to use at a glance.
+"""
+
+_SYSTEM_MSG = {"role": "system", "content": STATIC_PREFIX}
+
+# Per-request prompt templates, filled with str.format_map so the literal text is built once
+_GEN_TEMPLATE = """
+    Create a lesson plan.
     
-    Specific Inputs:
+    - Year Group: {year_group}
+    - Number of Lessons: {num_lessons}
+    - Enquiry Question: "{enquiry_question}"
     - Learning Objectives: {objectives}
     - Active Learning Activities: {active_learning}
     - Adaptive Teaching Practices: {adaptive_practices}
+    """
+
+# Multi-lesson plans are outlined first, then each lesson is written by its own concurrent call
+_OUTLINE_TEMPLATE = """
+    Before writing any lessons, outline the sequence. Return a JSON object
+    {{"title": plan_title, "lessons": [{{"title": lesson_title, "objective": one_line_objective}}, ...]}}
+    with exactly {num_lessons} lessons in teaching order.
+    """
+
+_LESSON_TEMPLATE = """
+    Write only Lesson {lesson_number} of {num_lessons}: {title}
+    Learning Objective: {objective}
     
-    For each lesson, provide:
-    1. Lesson Title & Learning Objective
-    2. Key Vocabulary
-    3. Main Activities (including timings)
-    4. Differentiation Strategies
-    5. Assessment Opportunities
-    6. Resources Needed
-    7. Home Learning Extensions
+    Earlier lessons in the sequence:
+    {prior_titles}
     
-    Format the output using markdown for clear structure.
+    Build on the earlier lessons without repeating them. Start with the heading
+    "## Lesson {lesson_number}: {title}" and include every section of the lesson structure.
     """
+
+_BASE_PLAN_TEMPLATE = "Base Lesson Plan:\n\n{base_plan}"
+
+# Separates the revised plan from the follow-up suggestions in a full-plan refinement
+SUGGESTIONS_DELIMITER = "===SUGGESTIONS==="
+
+_REFINE_TEMPLATE = """
+    User Comments:
+    {user_comments}
+    
+    Provide a revised lesson plan incorporating the user's feedback. Then, on a line of its own,
+    write """ + SUGGESTIONS_DELIMITER + """ followed by up to three short bullet points suggesting further
+    improvements the teacher could make to the plan.
+    """
+
+_REFINE_SECTIONS_TEMPLATE = """
+    User Comments:
+    {user_comments}
+    
+    Revise the base lesson plan to incorporate the user's feedback. Return a JSON object
+    {{"lessons": {{lesson_number: new_markdown}}, "suggestions": [suggestion, ...]}}.
+    "lessons" contains only the lessons that need to change. Each new_markdown value must be the
+    complete revised lesson, starting with its "## Lesson N: Title" heading. Use a new lesson number
+    to add a lesson and null to remove one, and use {{}} if no lesson needs to change.
+    "suggestions" lists up to three short further improvements the teacher could make to the plan.
+    """
+
+_SUMMARY_TEMPLATE = """
+    Teacher's Request:
+    {user_comments}
     
+    In at most five short bullet points, summarise the changes that should be made to the
+    base lesson plan. Do not rewrite the plan.
+    """
+
+_CLASSIFY_MSG = {
+    "role": "system",
+    "content": "A teacher is chatting about their lesson plan. If the message asks for the plan to be changed, return MODIFY. If it asks a question or discusses the plan without asking for changes, return DISCUSS. Return only MODIFY or DISCUSS."
+}
+
+_CHAT_SYSTEM_MSG = {
+    "role": "system",
+    "content": "You are an expert educator helping to refine and improve lesson plans. Provide specific, actionable suggestions and be ready to modify the plan based on teacher requests."
+}
+
+
+def _chat_payload(
+    model: str,
+    messages: list,
+    temperature: float,
+    max_tokens: int,
+    response_format: Optional[dict] = None,
+    stream: bool = False
+) -> dict:
+    """Request body for the chat completions endpoint"""
+    payload = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens
+    }
+    if response_format:
+        payload["response_format"] = response_format
+    if stream:
+        payload["stream"] = True
+    return payload
+
+
+def _raise_for_openai_error(response: httpx.Response) -> None:
+    """Raise with the API's own error message for a failed request"""
+    if response.is_error:
+        try:
+            message = response.json()["error"]["message"]
+        except Exception:
+            message = response.text
+        raise RuntimeError(f"OpenAI API error {response.status_code}: {message}")
+
+
+class TruncatedCompletionError(RuntimeError):
+    """The completion stopped at max_tokens; content holds the text produced before the cut-off"""
+
+    def __init__(self, content: str):
+        super().__init__("The response reached its output token limit and was cut off")
+        self.content = content
+
+
+def _retry_delay(attempt: int, response: Optional[httpx.Response] = None) -> float:
+    """Seconds to wait before retrying, honouring the server's Retry-After headers"""
+    if response is not None:
+        for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+            try:
+                return min(float(response.headers[header]) * scale, 60.0)
+            except (KeyError, ValueError):
+                pass
+    return min(0.5 * 2 ** attempt, 8.0) * random.uniform(0.75, 1.25)
+
+
+def _send_with_retries(send, max_retries: int = MAX_RETRIES) -> httpx.Response:
+    """Call send() until it returns a response that should not be retried, or retries run out"""
+    for attempt in range(max_retries + 1):
+        try:
+            response = send()
+        except httpx.TransportError:
+            if attempt == max_retries:
+                raise
+            time.sleep(_retry_delay(attempt))
+            continue
+        if response.status_code not in RETRY_STATUSES or attempt == max_retries:
+            return response
+        time.sleep(_retry_delay(attempt, response))
+
+
+async def _asend_with_retries(send, max_retries: int = MAX_RETRIES) -> httpx.Response:
+    """Async counterpart of _send_with_retries; send returns an awaitable response"""
+    for attempt in range(max_retries + 1):
+        try:
+            response = await send()
+        except httpx.TransportError:
+            if attempt == max_retries:
+                raise
+            await asyncio.sleep(_retry_delay(attempt))
+            continue
+        if response.status_code not in RETRY_STATUSES or attempt == max_retries:
+            return response
+        await asyncio.sleep(_retry_delay(attempt, response))
+
+
+def _chat_content(response: httpx.Response) -> str:
+    """Message content of a chat completions response"""
+    _raise_for_openai_error(response)
+    choice = response.json()["choices"][0]
+    if choice.get("finish_reason") == "length":
+        raise TruncatedCompletionError(choice["message"]["content"] or "")
+    return choice["message"]["content"]
+
+
+def _create_completion(
+    model: str,
+    messages: list,
+    temperature: float,
+    max_tokens: int,
+    response_format: Optional[dict] = None
+) -> str:
+    """Call the chat completions endpoint and return the message content"""
+    payload = _chat_payload(model, messages, temperature, max_tokens, response_format)
+    http = _http_client()
+    return _chat_content(_send_with_retries(lambda: http.post("/chat/completions", json=payload)))
+
+
+def _iter_sse_chunks(lines) -> Iterator[tuple]:
+    """Yield (content_delta, finish_reason) for each chunk of a streamed chat completion"""
+    for line in lines:
+        # Server-sent events: each chunk arrives as "data: {json}", ending with "data: [DONE]"
+        if not line.startswith("data: "):
+            continue
+        data = line[len("data: "):]
+        if data == "[DONE]":
+            return
+        choices = json.loads(data)["choices"]
+        if choices:
+            yield choices[0]["delta"].get("content") or "", choices[0].get("finish_reason")
+
+
+def _stream_completion(model: str, messages: list, temperature: float, max_tokens: int, placeholder) -> str:
+    """Stream a completion into a placeholder as it arrives and return the full text.
+
+    A response cut off below MAX_OUTPUT_TOKENS is streamed again once with the full budget.
+    """
     try:
-        response = client.chat.completions.create(
-            model="gpt-4-turbo-preview",
-            messages=[
-                {"role": "system", "content": "You are an experienced educator with expertise in lesson planning."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7,
-            max_tokens=4000
+        return _stream_completion_once(model, messages, temperature, max_tokens, placeholder)
+    except TruncatedCompletionError:
+        if max_tokens >= MAX_OUTPUT_TOKENS:
+            raise
+        return _stream_completion_once(model, messages, temperature, MAX_OUTPUT_TOKENS, placeholder)
+
+
+def _stream_completion_once(
+    model: str,
+    messages: list,
+    temperature: float,
+    max_tokens: int,
+    placeholder
+) -> str:
+    """Single streamed attempt for _stream_completion, raising TruncatedCompletionError on a cut-off"""
+    payload = _chat_payload(model, messages, temperature, max_tokens, stream=True)
+    for attempt in range(MAX_RETRIES + 1):
+        content = ""
+        finish_reason = None
+        try:
+            with _http_client().stream(
+                "POST", "/chat/completions", json=payload, timeout=OPENAI_STREAM_TIMEOUT
+            ) as response:
+                if response.status_code in RETRY_STATUSES and attempt < MAX_RETRIES:
+                    delay = _retry_delay(attempt, response)
+                else:
+                    if response.is_error:
+                        response.read()
+                        _raise_for_openai_error(response)
+                    for delta, chunk_finish_reason in _iter_sse_chunks(response.iter_lines()):
+                        content += delta
+                        finish_reason = chunk_finish_reason or finish_reason
+                        placeholder.markdown(content)
+                    if finish_reason == "length":
+                        raise TruncatedCompletionError(content)
+                    return content
+        except httpx.TransportError:
+            # A dropped stream is restarted from scratch; the placeholder is overwritten as it refills
+            if attempt == MAX_RETRIES:
+                raise
+            delay = _retry_delay(attempt)
+        time.sleep(delay)
+
+
+class CacheBackend(Protocol):
+    """Key-value and capped-list store that outlives the Streamlit process"""
+
+    def get(self, key: str) -> Optional[str]:
+        ...
+
+    def set(self, key: str, value: str) -> None:
+        ...
+
+    def push(self, key: str, item: bytes, max_len: int) -> None:
+        """Append item to the list at key, keeping only the newest max_len items"""
+        ...
+
+    def items(self, key: str) -> list:
+        """Every item in the list at key, oldest first"""
+        ...
+
+
+class DiskCacheBackend:
+    """CacheBackend on a local diskcache directory; survives restarts of a single instance"""
+
+    def __init__(self, directory: str = PERSISTENT_CACHE_DIR):
+        import diskcache
+
+        self._cache = diskcache.Cache(directory)
+
+    def get(self, key: str) -> Optional[str]:
+        return self._cache.get(key)
+
+    def set(self, key: str, value: str) -> None:
+        self._cache.set(key, value, expire=CACHE_TTL_SECONDS)
+
+    def push(self, key: str, item: bytes, max_len: int) -> None:
+        # The transaction makes the read-modify-write atomic across processes sharing the directory
+        with self._cache.transact():
+            items = (self._cache.get(key, []) + [item])[-max_len:]
+            self._cache.set(key, items, expire=CACHE_TTL_SECONDS)
+
+    def items(self, key: str) -> list:
+        return self._cache.get(key, [])
+
+
+class RedisCacheBackend:
+    """CacheBackend on Redis; shared by every server instance pointing at the same URL"""
+
+    def __init__(self, url: str):
+        import redis
+
+        # Raw bytes, since list items carry binary embeddings; strings are decoded in get
+        self._redis = redis.Redis.from_url(
+            url, socket_connect_timeout=REDIS_TIMEOUT_SECONDS, socket_timeout=REDIS_TIMEOUT_SECONDS
         )
-        return response.choices[0].message.content
-    except Exception as e:
-        st.error(f"Error generating lesson plan: {str(e)}")
+
+    def get(self, key: str) -> Optional[str]:
+        value = self._redis.get(key)
+        return None if value is None else value.decode("utf-8")
+
+    def set(self, key: str, value: str) -> None:
+        self._redis.set(key, value, ex=CACHE_TTL_SECONDS)
+
+    def push(self, key: str, item: bytes, max_len: int) -> None:
+        # RPUSH only sends the new item, so instances appending at once never overwrite each other
+        pipe = self._redis.pipeline()
+        pipe.rpush(key, item)
+        pipe.ltrim(key, -max_len, -1)
+        pipe.expire(key, CACHE_TTL_SECONDS)
+        pipe.execute()
+
+    def items(self, key: str) -> list:
+        return self._redis.lrange(key, 0, -1)
+
+
+@st.cache_resource
+def _persistent_cache() -> Optional[CacheBackend]:
+    """The configured persistent cache backend, or None when persistence is disabled"""
+    if not ENABLE_PERSISTENT_CACHE:
+        return None
+    redis_url = st.secrets.get("REDIS_URL")
+    if redis_url:
+        return RedisCacheBackend(redis_url)
+    return DiskCacheBackend()
+
+
+def _cache_get(key: str) -> Optional[str]:
+    """Read from the persistent cache; an unavailable backend counts as a miss"""
+    # Building the backend can fail too (e.g. an unwritable cache directory)
+    try:
+        backend = _persistent_cache()
+        return None if backend is None else backend.get(key)
+    except Exception:
         return None
 
-def refine_lesson_plan_with_openai(base_plan: str, user_comments: str) -> Optional[str]:
-    """Refine the lesson plan using OpenAI's GPT model based on user comments."""
-    prompt = f"""
-    You are an expert educator. Refine the following lesson plan based on the user's comments.
+
+def _cache_set(key: str, value: str) -> None:
+    """Write to the persistent cache, ignoring backend failures"""
+    try:
+        backend = _persistent_cache()
+        if backend is not None:
+            backend.set(key, value)
+    except Exception:
+        pass
+
+
+def _cache_push(key: str, item: bytes, max_len: int) -> None:
+    """Append to a persistent capped list, ignoring backend failures"""
+    try:
+        backend = _persistent_cache()
+        if backend is not None:
+            backend.push(key, item, max_len)
+    except Exception:
+        pass
+
+
+def _cache_items(key: str) -> list:
+    """Read a persistent list; an unavailable backend counts as empty"""
+    try:
+        backend = _persistent_cache()
+        return [] if backend is None else backend.items(key)
+    except Exception:
+        return []
+
+
+def _completion_cache_key(
+    model: str,
+    messages: list,
+    temperature: float,
+    max_tokens: int,
+    response_format: Optional[dict]
+) -> str:
+    """Stable persistent cache key for a completion request"""
+    request = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "response_format": response_format
+    }
+    return "completion:" + hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def _cached_completion(
+    model: str,
+    messages: list,
+    temperature: float,
+    max_tokens: int,
+    response_format: Optional[dict] = None
+) -> str:
+    """Exact-match cache over (model, messages, temperature, max_tokens, response_format).
+
+    Backed by the persistent cache, when enabled, so hits survive restarts.
+    """
+    key = _completion_cache_key(model, messages, temperature, max_tokens, response_format)
+    content = _cache_get(key)
+    if content is None:
+        content = _create_completion(model, messages, temperature, max_tokens, response_format)
+        _cache_set(key, content)
+    return content
+
+
+def _completion(
+    model: str,
+    messages: list,
+    temperature: float,
+    max_tokens: int,
+    response_format: Optional[dict] = None,
+    retry_truncated: bool = True
+) -> str:
+    """Return a completion, serving repeats from cache when the output is deterministic.
+
+    A response cut off below MAX_OUTPUT_TOKENS is requested again once with the full budget
+    unless retry_truncated is False. Truncated responses raise and so are never cached.
+    """
+    # Sampling at temperature > 0 is meant to vary, so only temperature == 0 is cached
+    complete = _cached_completion if temperature == 0 else _create_completion
+    try:
+        return complete(model, messages, temperature, max_tokens, response_format)
+    except TruncatedCompletionError:
+        if not retry_truncated or max_tokens >= MAX_OUTPUT_TOKENS:
+            raise
+        return complete(model, messages, temperature, MAX_OUTPUT_TOKENS, response_format)
+
+
+@st.cache_resource
+def _event_loop() -> asyncio.AbstractEventLoop:
+    """Long-lived event loop on a daemon thread for running OpenAI calls concurrently.
+
+    Streamlit scripts run synchronously, so coroutines are submitted to this loop rather
+    than started with asyncio.run on every rerun.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+def _submit(coro) -> concurrent.futures.Future:
+    """Schedule a coroutine on the background loop and return a future for its result"""
+    return asyncio.run_coroutine_threadsafe(coro, _event_loop())
+
+
+async def _acreate_completion(
+    model: str,
+    messages: list,
+    temperature: float,
+    max_tokens: int,
+    response_format: Optional[dict] = None
+) -> str:
+    """Async counterpart of _create_completion"""
+    payload = _chat_payload(model, messages, temperature, max_tokens, response_format)
+    ahttp = _async_http_client()
+    return _chat_content(await _asend_with_retries(lambda: ahttp.post("/chat/completions", json=payload)))
+
+
+async def _acompletion(
+    model: str,
+    messages: list,
+    temperature: float,
+    max_tokens: int,
+    response_format: Optional[dict] = None,
+    retry_truncated: bool = True
+) -> str:
+    """Async counterpart of _completion, sharing the same exact-match cache"""
+    async def complete(tokens: int) -> str:
+        if temperature == 0:
+            return await asyncio.to_thread(
+                _cached_completion, model, messages, temperature, tokens, response_format
+            )
+        return await _acreate_completion(model, messages, temperature, tokens, response_format)
     
-    Base Lesson Plan:
-    {base_plan}
+    try:
+        return await complete(max_tokens)
+    except TruncatedCompletionError:
+        if not retry_truncated or max_tokens >= MAX_OUTPUT_TOKENS:
+            raise
+        return await complete(MAX_OUTPUT_TOKENS)
+
+
+@st.cache_resource
+def _embedding_cache() -> dict:
+    """Past request embeddings and plans, shared across reruns and sessions.
+
+    Entries are partitioned by (year_group, num_lessons) since a plan for a different
+    year group or lesson count is never a valid hit, however similar the wording. With the
+    persistent cache enabled this is a local copy, refreshed from the backend on a miss.
+    """
+    return {"lock": threading.Lock(), "partitions": {}}
+
+
+def _embed(text: str) -> np.ndarray:
+    """Embed text with the OpenAI embeddings endpoint"""
+    payload = {"model": EMBEDDING_MODEL, "input": text}
+    http = _http_client()
+    response = _send_with_retries(
+        lambda: http.post("/embeddings", json=payload, timeout=EMBEDDING_TIMEOUT), EMBEDDING_MAX_RETRIES
+    )
+    _raise_for_openai_error(response)
+    return np.asarray(response.json()["data"][0]["embedding"], dtype=np.float32)
+
+
+async def _aembed(text: str) -> np.ndarray:
+    """Async counterpart of _embed"""
+    payload = {"model": EMBEDDING_MODEL, "input": text}
+    ahttp = _async_http_client()
+    response = await _asend_with_retries(
+        lambda: ahttp.post("/embeddings", json=payload, timeout=EMBEDDING_TIMEOUT), EMBEDDING_MAX_RETRIES
+    )
+    _raise_for_openai_error(response)
+    return np.asarray(response.json()["data"][0]["embedding"], dtype=np.float32)
+
+
+def _semantic_query_text(enquiry_question: str, objectives: str) -> str:
+    """Text embedded for semantic cache lookups"""
+    return f"{enquiry_question}\n{objectives}"
+
+
+def prefetch_embedding() -> None:
+    """on_change callback that starts embedding the enquiry while the teacher fills in the rest.
+
+    The request runs on the background loop, so by the time Generate is clicked the
+    semantic cache lookup usually has its embedding ready.
+    """
+    enquiry_question = st.session_state.get("enquiry_question", "")
+    if not enquiry_question:
+        return
+    text = _semantic_query_text(enquiry_question, st.session_state.get("objectives", ""))
+    prefetched = st.session_state.get("prefetched_embedding")
+    if prefetched is None or prefetched["text"] != text:
+        st.session_state.prefetched_embedding = {"text": text, "future": _submit(_aembed(text))}
+
+
+def _query_embedding(text: str) -> np.ndarray:
+    """Embedding for text, reusing the prefetched one when the inputs have not changed since.
+
+    Raises TimeoutError if the prefetch is still running after PREFETCH_WAIT_SECONDS; the
+    caller then skips the semantic cache instead of waiting on an optimisation.
+    """
+    prefetched = st.session_state.get("prefetched_embedding")
+    if prefetched is not None and prefetched["text"] == text:
+        try:
+            return prefetched["future"].result(timeout=PREFETCH_WAIT_SECONDS)
+        except concurrent.futures.TimeoutError:
+            raise
+        except Exception:
+            pass  # Retry below in case the speculative request failed
+    return _embed(text)
+
+
+def _semantic_cache_key(partition: tuple) -> str:
+    """Persistent cache key of the list holding one semantic cache partition's entries"""
+    return "semantic-entries:" + ":".join([EMBEDDING_MODEL, *map(str, partition)])
+
+
+# Persisted entry layout: created timestamp and plan length, then the UTF-8 plan and float32 vector
+_SEMANTIC_ENTRY_HEADER = struct.Struct("<dI")
+
+
+def _encode_semantic_entry(created: float, query_vec: np.ndarray, plan: str) -> bytes:
+    """Serialise one semantic cache entry for the persistent cache"""
+    plan_bytes = plan.encode("utf-8")
+    return (
+        _SEMANTIC_ENTRY_HEADER.pack(created, len(plan_bytes))
+        + plan_bytes
+        + np.asarray(query_vec, dtype="<f4").tobytes()
+    )
+
+
+def _decode_semantic_entry(item: bytes) -> tuple:
+    """Inverse of _encode_semantic_entry, returning (created, embedding, plan)"""
+    created, plan_length = _SEMANTIC_ENTRY_HEADER.unpack_from(item)
+    offset = _SEMANTIC_ENTRY_HEADER.size
+    plan = item[offset:offset + plan_length].decode("utf-8")
+    embedding = np.frombuffer(item, dtype="<f4", offset=offset + plan_length)
+    return created, embedding, plan
+
+
+def _partition_entries(created: list, embeddings: list, plans: list) -> Optional[dict]:
+    """In-memory partition from parallel entry lists, keeping the newest unexpired entries"""
+    cutoff = time.time() - CACHE_TTL_SECONDS
+    live = [i for i, stored_at in enumerate(created) if stored_at > cutoff][-SEMANTIC_CACHE_MAX_ENTRIES:]
+    if not live:
+        return None
+    return {
+        "created": [created[i] for i in live],
+        "embeddings": np.stack([embeddings[i] for i in live]).astype(np.float32),
+        "plans": [plans[i] for i in live]
+    }
+
+
+def _load_semantic_partition(partition: tuple) -> Optional[dict]:
+    """Read a partition's unexpired entries from the persistent cache"""
+    entries = [_decode_semantic_entry(item) for item in _cache_items(_semantic_cache_key(partition))]
+    return _partition_entries(*map(list, zip(*entries))) if entries else None
+
+
+def _best_match(entry: Optional[dict], query_vec: np.ndarray, threshold: float) -> Optional[str]:
+    """The unexpired plan in entry most similar to query_vec, if it clears the threshold"""
+    if entry is None:
+        return None
+    E = entry["embeddings"]
+    sims = E @ query_vec / (np.linalg.norm(E, axis=1) * np.linalg.norm(query_vec))
+    # Each entry expires CACHE_TTL_SECONDS after it was stored, however recently the partition changed
+    sims[np.asarray(entry["created"]) <= time.time() - CACHE_TTL_SECONDS] = -np.inf
+    best = int(np.argmax(sims))
+    if sims[best] > threshold:
+        return entry["plans"][best]
+    return None
+
+
+def _semantic_lookup(
+    query_vec: np.ndarray,
+    partition: tuple,
+    threshold: float = SEMANTIC_CACHE_THRESHOLD
+) -> Optional[str]:
+    """Return the stored plan most similar to query_vec if it clears the threshold"""
+    cache = _embedding_cache()
+    with cache["lock"]:
+        entry = cache["partitions"].get(partition)
+    plan = _best_match(entry, query_vec, threshold)
+    if plan is None and ENABLE_PERSISTENT_CACHE:
+        # Other instances may have stored a match since this one last read the partition
+        entry = _load_semantic_partition(partition)
+        if entry is not None:
+            with cache["lock"]:
+                cache["partitions"][partition] = entry
+        plan = _best_match(entry, query_vec, threshold)
+    return plan
+
+
+def _semantic_store(query_vec: np.ndarray, partition: tuple, plan: str) -> None:
+    """Add a generated plan and its embedding to the semantic cache"""
+    created = time.time()
+    cache = _embedding_cache()
+    with cache["lock"]:
+        entry = cache["partitions"].get(partition) or {"created": [], "embeddings": [], "plans": []}
+        # Replace rather than mutate so concurrent lookups keep a consistent snapshot
+        cache["partitions"][partition] = _partition_entries(
+            entry["created"] + [created], [*entry["embeddings"], query_vec], entry["plans"] + [plan]
+        )
     
-    User Comments:
-    {user_comments}
+    # Only the new entry is sent; the backend appends it and trims the list to the newest entries
+    if ENABLE_PERSISTENT_CACHE:
+        _cache_push(
+            _semantic_cache_key(partition),
+            _encode_semantic_entry(created, query_vec, plan),
+            SEMANTIC_CACHE_MAX_ENTRIES
+        )
+
+
+def _lesson_plan_prompt(
+    enquiry_question: str,
+    year_group: str,
+    num_lessons: int,
+    objectives: str,
+    active_learning: str,
+    adaptive_practices: str
+) -> str:
+    """Build the user prompt for generating a lesson plan.
+
+    Only the per-request fields go here; the instructions live in STATIC_PREFIX.
+    """
+    return _GEN_TEMPLATE.format_map(locals())
+
+def _plan_max_tokens(num_lessons: int) -> int:
+    """Output ceiling for a plan with num_lessons lessons.
+
+    Never below LESSON_MAX_TOKENS, since a one-lesson plan is a standalone lesson and
+    running out would mean streaming the whole plan again at MAX_OUTPUT_TOKENS.
+    """
+    return min(MAX_OUTPUT_TOKENS, max(LESSON_MAX_TOKENS, TOKENS_PER_LESSON * num_lessons + 300))
+
+def _refine_max_tokens(base_plan: str) -> int:
+    """Output ceiling for a refinement, scaled to the size of the plan (about 3 chars per token)"""
+    return min(MAX_OUTPUT_TOKENS, len(base_plan) // 3 + 500)
+
+def _lesson_plan_completion_args(prompt: str, num_lessons: int) -> dict:
+    """Model settings shared by real-time and batch lesson plan generation"""
+    return dict(
+        model=GENERATE_MODEL,
+        messages=[_SYSTEM_MSG, {"role": "user", "content": prompt}],
+        temperature=0 if DETERMINISTIC_MODE else 0.7,
+        max_tokens=_plan_max_tokens(num_lessons)
+    )
+
+async def outline_lesson_plan(prompt: str, num_lessons: int) -> dict:
+    """Outline a plan as {"title": ..., "lessons": [{"title": ..., "objective": ...}]}"""
+    response = await _acompletion(
+        model=GENERATE_MODEL,
+        messages=[
+            _SYSTEM_MSG,
+            {"role": "user", "content": prompt},
+            {"role": "user", "content": _OUTLINE_TEMPLATE.format_map(locals())}
+        ],
+        temperature=0 if DETERMINISTIC_MODE else 0.7,
+        max_tokens=600,
+        response_format={"type": "json_object"}
+    )
+    outline = json.loads(response)
+    lessons = outline.get("lessons") if isinstance(outline, dict) else None
+    if not isinstance(lessons, list) or len(lessons) != num_lessons:
+        raise ValueError(f"Outline does not list the expected {num_lessons} lessons")
+    # Entries are formatted into every lesson request, so reject malformed ones up front
+    for number, lesson in enumerate(lessons, start=1):
+        title = lesson.get("title") if isinstance(lesson, dict) else None
+        if not isinstance(title, str) or not title.strip():
+            raise ValueError(f"Outline lesson {number} has no title")
+    return outline
+
+async def generate_single_lesson(prompt: str, outline: dict, index: int) -> str:
+    """Write one lesson of an outlined plan, given only the titles of the lessons before it"""
+    lessons = outline["lessons"]
+    lesson = lessons[index]
+    prior_titles = "\n".join(
+        f"- Lesson {number}: {prior['title']}" for number, prior in enumerate(lessons[:index], start=1)
+    ) or "- None, this is the first lesson"
+    request = _LESSON_TEMPLATE.format(
+        lesson_number=index + 1,
+        num_lessons=len(lessons),
+        title=lesson["title"],
+        objective=lesson.get("objective", ""),
+        prior_titles=prior_titles
+    )
     
-    Provide a revised lesson plan incorporating the user's feedback.
+    return await _acompletion(
+        model=GENERATE_MODEL,
+        messages=[
+            _SYSTEM_MSG,
+            {"role": "user", "content": prompt},
+            {"role": "user", "content": request}
+        ],
+        temperature=0 if DETERMINISTIC_MODE else 0.7,
+        max_tokens=LESSON_MAX_TOKENS
+    )
+
+def _outline_progress(outline: dict, lessons: list) -> str:
+    """Markdown for a partly written plan: finished lessons, and outline headings for the rest"""
+    sections = [f"# {outline['title']}"] if outline.get("title") else []
+    for number, (entry, lesson) in enumerate(zip(outline["lessons"], lessons), start=1):
+        if lesson is None:
+            lesson = f"## Lesson {number}: {entry['title']}\n\n⏳ *Writing...*"
+        sections.append(lesson)
+    return "\n\n".join(sections)
+
+def _generate_from_outline(prompt: str, outline: dict, placeholder) -> tuple:
+    """Write every lesson of an outline concurrently, showing each one as it completes.
+
+    The outline is shown straight away and each lesson replaces its heading as it arrives.
+    Lessons that fail are retried once without discarding the ones that finished. Returns
+    (plan, truncated), where truncated is True if any lesson was cut off.
+    """
+    lessons = [None] * len(outline["lessons"])
+    truncated = False
+    placeholder.markdown(_outline_progress(outline, lessons))
+    pending = range(len(lessons))
+    for _ in range(2):
+        futures = {_submit(generate_single_lesson(prompt, outline, index)): index for index in pending}
+        failed = []
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                lesson = future.result()
+            except TruncatedCompletionError as e:
+                lesson, truncated = e.content, True
+            except Exception:
+                failed.append(futures[future])
+                continue
+            # The plan is split at these headings for refinements, so normalise each one
+            index = futures[future]
+            title = outline["lessons"][index]["title"]
+            lessons[index] = _numbered_lesson(lesson, index + 1, f"## Lesson {index + 1}: {title}")
+            placeholder.markdown(_outline_progress(outline, lessons))
+        if not failed:
+            return _outline_progress(outline, lessons), truncated
+        pending = failed
+    numbers = ", ".join(str(index + 1) for index in sorted(failed))
+    raise RuntimeError(f"Could not write lesson(s) {numbers}")
+
+def generate_lesson_plan_with_openai(
+    enquiry_question: str,
+    year_group: str,
+    num_lessons: int,
+    objectives: str,
+    active_learning: str,
+    adaptive_practices: str,
+    placeholder=None
+) -> Optional[str]:
+    """Generate a lesson plan using OpenAI's GPT model, showing progress in placeholder.
+
+    Plans with several lessons are outlined first and then written one lesson per
+    concurrent request, so wall time is close to that of the slowest single lesson. A plan
+    that was cut off sets st.session_state.plan_notice for the chat to show.
     """
+    st.session_state.plan_notice = None
+    prompt = _lesson_plan_prompt(
+        enquiry_question, year_group, num_lessons, objectives, active_learning, adaptive_practices
+    )
     
+    partition = (year_group, num_lessons)
     try:
-        response = client.chat.completions.create(
-            model="gpt-4-turbo-preview",
-            messages=[
-                {"role": "system", "content": "You are an experienced educator with expertise in lesson planning."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7,
-            max_tokens=4000
+        query_vec = _query_embedding(_semantic_query_text(enquiry_question, objectives))
+    except Exception:
+        # The semantic cache is an optimisation; fall through to generation without it
+        query_vec = None
+    if query_vec is not None:
+        cached_plan = _semantic_lookup(query_vec, partition)
+        if cached_plan is not None:
+            return cached_plan
+
+    placeholder = placeholder or st.empty()
+    outline = None
+    if num_lessons > 1:
+        try:
+            outline = _submit(outline_lesson_plan(prompt, num_lessons)).result()
+        except Exception:
+            pass  # Fall back to generating the whole plan in a single request
+    
+    plan, truncated = None, False
+    if outline:
+        try:
+            plan, truncated = _generate_from_outline(prompt, outline, placeholder)
+        except Exception:
+            pass  # Some lessons kept failing, so write the whole plan in a single request instead
+    
+    if plan is None:
+        completion_args = _lesson_plan_completion_args(prompt, num_lessons)
+        try:
+            # Deterministic requests go through the exact-match cache, which needs the full response
+            if DETERMINISTIC_MODE or st.session_state.get("stream_disabled"):
+                plan = _completion(**completion_args)
+            else:
+                plan = _stream_completion(**completion_args, placeholder=placeholder)
+        except TruncatedCompletionError as e:
+            plan, truncated = e.content, True
+        except Exception as e:
+            st.error(f"Error generating lesson plan: {str(e)}")
+            return None
+
+    if truncated:
+        # Keep the partial plan for the teacher to refine, but never serve it to anyone else.
+        # The page reruns into the chat straight after, so the notice is shown there.
+        st.session_state.plan_notice = (
+            "⚠️ The lesson plan reached the output limit and may be cut off. "
+            "Try fewer lessons, or ask here for the missing parts."
+        )
+    elif query_vec is not None and plan:
+        _semantic_store(query_vec, partition, plan)
+    return plan
+
+def build_batch_request(custom_id: str, prompt: str, num_lessons: int) -> dict:
+    """Build one Batch API request line for a lesson plan prompt"""
+    args = _lesson_plan_completion_args(prompt, num_lessons)
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": args["model"],
+            "messages": args["messages"],
+            "temperature": args["temperature"],
+            "max_tokens": args["max_tokens"]
+        }
+    }
+
+def submit_lesson_plan_batch(batch_requests: list) -> Optional[str]:
+    """Upload lesson plan requests as JSONL and start a 24h batch, returning its id"""
+    jsonl = "\n".join(json.dumps(request) for request in batch_requests)
+    try:
+        client = _openai_client()
+        batch_file = client.files.create(file=("lesson_plans.jsonl", jsonl.encode("utf-8")), purpose="batch")
+        batch = client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
         )
-        return response.choices[0].message.content
+        return batch.id
     except Exception as e:
-        st.error(f"Error refining lesson plan: {str(e)}")
+        st.error(f"Error submitting batch: {str(e)}")
         return None
 
+# Batch statuses after which no more requests will run
+BATCH_TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+def _parse_batch_output(text: str) -> tuple:
+    """Parse Batch API output or error JSONL into ({custom_id: plan}, [(custom_id, error), ...])"""
+    plans, errors = {}, []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        custom_id = result.get("custom_id", "unknown request")
+        response = result.get("response") or {}
+        body = response.get("body") or {}
+        if response.get("status_code") == 200:
+            choice = body["choices"][0]
+            plans[custom_id] = choice["message"]["content"]
+            if choice.get("finish_reason") == "length":
+                errors.append((custom_id, "plan was cut off at the output token limit"))
+        else:
+            error = result.get("error") or body.get("error") or {}
+            status = response.get("status_code")
+            errors.append((custom_id, error.get("message") or f"request failed with status {status}"))
+    return plans, errors
+
+def retrieve_lesson_plan_batch(batch_id: str) -> tuple:
+    """Return (status, {custom_id: plan}, [(custom_id, error), ...]) for a batch.
+
+    Plans and errors are only populated once the batch reaches a terminal status; an
+    expired or cancelled batch still returns the requests that finished in time.
+    """
+    try:
+        client = _openai_client()
+        batch = client.batches.retrieve(batch_id)
+        if batch.status not in BATCH_TERMINAL_STATUSES:
+            return batch.status, {}, []
+        plans, errors = {}, []
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                file_plans, file_errors = _parse_batch_output(client.files.content(file_id).text)
+                plans.update(file_plans)
+                errors.extend(file_errors)
+        # Batches that fail validation report their errors on the batch rather than in a file
+        if batch.errors and batch.errors.data:
+            errors.extend(("batch", error.message) for error in batch.errors.data)
+    except Exception as e:
+        st.error(f"Error retrieving batch: {str(e)}")
+        return "error", {}, []
+    return batch.status, plans, errors
+
+def _batch_titles(batch_id: str) -> dict:
+    """Enquiry titles of a batch's requests, from this session or the persistent cache"""
+    if st.session_state.get("batch_titles_id") == batch_id:
+        return st.session_state.batch_titles
+    stored = _cache_get(f"batch:{batch_id}")
+    return json.loads(stored) if stored else {}
+
+# Lesson headings as required by STATIC_PREFIX, e.g. "## Lesson 2: Magnetic materials"
+LESSON_HEADING = re.compile(r"^#{1,4}\s*\**\s*Lesson\s+(\d+)\b", re.IGNORECASE | re.MULTILINE)
+
+def _heading_level(match: re.Match) -> int:
+    """Number of leading "#"s of a LESSON_HEADING match"""
+    return len(match.group(0)) - len(match.group(0).lstrip("#"))
+
+def _lesson_headings(plan: str) -> list:
+    """Lesson heading matches at the plan's top heading level.
+
+    Deeper headings that mention a lesson, e.g. "### Lesson 2 resources" inside lesson 2,
+    belong to the enclosing lesson rather than starting a new one.
+    """
+    matches = list(LESSON_HEADING.finditer(plan))
+    if not matches:
+        return []
+    top = min(_heading_level(match) for match in matches)
+    return [match for match in matches if _heading_level(match) == top]
+
+def split_lesson_sections(plan: str) -> dict:
+    """Split a plan into {0: preamble, 1: lesson 1, ...} markdown sections.
+
+    Returns an empty dict when the plan has no lesson headings or repeats a lesson number,
+    in which case it can only be refined as a whole.
+    """
+    matches = _lesson_headings(plan)
+    numbers = [int(match.group(1)) for match in matches]
+    if not matches or len(set(numbers)) != len(numbers):
+        return {}
+    
+    sections = {0: plan[:matches[0].start()].strip()}
+    ends = [match.start() for match in matches[1:]] + [len(plan)]
+    for number, match, end in zip(numbers, matches, ends):
+        sections[number] = plan[match.start():end].strip()
+    return sections
+
+def join_lesson_sections(sections: dict) -> str:
+    """Join lesson sections back into a single markdown plan"""
+    return "\n\n".join(sections[number] for number in sorted(sections) if sections[number])
+
+# Any markdown heading line, for shifting a lesson's headings to another level
+MARKDOWN_HEADING = re.compile(r"^(#{1,6})(?=\s)", re.MULTILINE)
+
+def _numbered_lesson(markdown: str, number: int, original: Optional[str] = None, level: int = 2) -> str:
+    """Lesson markdown opening with a level-`level` heading that carries number.
+
+    Text before the lesson's first heading (e.g. "Sure, here is lesson 2:") is dropped, and
+    the lesson's headings are shifted together so its opening heading sits at level. A
+    lesson without a heading gets the original lesson's heading line, or a bare
+    "Lesson N" heading, so it is still found when the plan is split again.
+    """
+    markdown = markdown.strip()
+    headings = _lesson_headings(markdown)
+    if headings:
+        markdown = markdown[headings[0].start():]
+        shift = level - _heading_level(headings[0])
+        if shift:
+            markdown = MARKDOWN_HEADING.sub(
+                lambda heading: "#" * min(6, max(1, len(heading.group(1)) + shift)), markdown
+            )
+        match = LESSON_HEADING.match(markdown)
+        return markdown[:match.start(1)] + str(number) + markdown[match.end(1):]
+    original_match = LESSON_HEADING.match(original or "")
+    if original_match:
+        heading = original.splitlines()[0]
+        heading = heading[:original_match.start(1)] + str(number) + heading[original_match.end(1):]
+    else:
+        heading = f"{'#' * level} Lesson {number}"
+    return f"{heading}\n\n{markdown}"
+
+def _lesson_level(section: Optional[str]) -> Optional[int]:
+    """Heading level of the lesson heading a section opens with, if any"""
+    match = LESSON_HEADING.match(section or "")
+    return _heading_level(match) if match else None
+
+def apply_lesson_patch(sections: dict, patch: dict) -> dict:
+    """Merge a {lesson_number: markdown} patch into sections; null removes a lesson.
+
+    Patched lessons take the heading level of the lesson they replace (or of the plan's
+    other lessons when added), lessons are renumbered consecutively afterwards, and every
+    heading is rewritten to match its section number, so the merged plan always splits
+    back into the same sections.
+    """
+    plan_level = next(
+        (_lesson_level(sections[number]) for number in sorted(sections) if number > 0), None
+    ) or 2
+    merged = dict(sections)
+    for number, markdown in patch.items():
+        if markdown is None:
+            merged.pop(number, None)
+        elif number == 0:
+            merged[0] = markdown.strip()
+        else:
+            original = sections.get(number)
+            level = _lesson_level(original) or plan_level
+            merged[number] = _numbered_lesson(markdown, number, original, level)
+    
+    renumbered = {0: merged[0]} if 0 in merged else {}
+    lessons = sorted(number for number in merged if number > 0)
+    for new_number, number in enumerate(lessons, start=1):
+        level = _lesson_level(merged[number]) or plan_level
+        renumbered[new_number] = _numbered_lesson(merged[number], new_number, level=level)
+    return renumbered
+
+def _refinement_messages(base_plan: str, request: str) -> list:
+    """Messages for calls about an existing plan, with the invariant parts first.
+
+    The refinement and its summary share STATIC_PREFIX and the base plan message, so
+    every call about the same plan can reuse the cached prefix.
+    """
+    return [
+        _SYSTEM_MSG,
+        {"role": "user", "content": _BASE_PLAN_TEMPLATE.format_map(locals())},
+        {"role": "user", "content": request}
+    ]
+
+def _refine_model(user_comments: str) -> str:
+    """Use the cheaper model for short, surface-level requests and escalate long ones"""
+    return REFINE_MODEL if len(user_comments) < REFINE_ESCALATION_CHARS else GENERATE_MODEL
+
+async def refine_lesson_plan_with_openai(base_plan: str, user_comments: str) -> tuple:
+    """Refine the lesson plan using OpenAI's GPT model based on user comments.
+
+    Returns (refined_plan, suggestions), where suggestions are further improvements the
+    teacher might ask for next, produced in the same request. Runs on the background event
+    loop, so errors are raised for the caller to report.
+    """
+    request = _REFINE_TEMPLATE.format_map(locals())
+    
+    try:
+        response = await _acompletion(
+            model=_refine_model(user_comments),
+            messages=_refinement_messages(base_plan, request),
+            temperature=0 if DETERMINISTIC_MODE else 0.7,
+            max_tokens=_refine_max_tokens(base_plan)
+        )
+    except TruncatedCompletionError as e:
+        # A cut-off plan would silently drop its final lessons, so keep the current plan instead
+        raise ValueError("The refined plan was cut off before it was complete, so no changes "
+                         "were applied. Try asking for fewer changes at once.") from e
+    refined_plan, _, suggestions = response.partition(SUGGESTIONS_DELIMITER)
+    return refined_plan.strip(), suggestions.strip()
+
+async def refine_lesson_sections_with_openai(base_plan: str, user_comments: str) -> tuple:
+    """Refine only the lessons affected by the user's comments.
+
+    Returns (patch, suggestions): a {lesson_number: new_markdown} patch for
+    apply_lesson_patch, so small tweaks cost a few hundred output tokens instead of a
+    regenerated plan, and further improvements produced in the same request.
+    """
+    request = _REFINE_SECTIONS_TEMPLATE.format_map(locals())
+    
+    try:
+        response = await _acompletion(
+            model=_refine_model(user_comments),
+            messages=_refinement_messages(base_plan, request),
+            temperature=0 if DETERMINISTIC_MODE else 0.7,
+            max_tokens=_refine_max_tokens(base_plan),
+            response_format={"type": "json_object"}
+        )
+    except TruncatedCompletionError as e:
+        raise ValueError("The refinement was cut off before its JSON patch was complete, so no "
+                         "changes were applied. Try asking for fewer changes at once.") from e
+    try:
+        result = json.loads(response)
+    except json.JSONDecodeError as e:
+        raise ValueError("The refinement was not valid JSON, so no changes were applied") from e
+    patch = {int(number): markdown for number, markdown in result.get("lessons", {}).items()}
+    suggestions = "\n".join(f"- {suggestion}" for suggestion in result.get("suggestions", []))
+    return patch, suggestions
+
+async def summarize_refinement(base_plan: str, user_comments: str) -> str:
+    """Summarise the changes a refinement will make, run alongside the refinement itself"""
+    request = _SUMMARY_TEMPLATE.format_map(locals())
+    
+    try:
+        return await _acompletion(
+            model=REFINE_MODEL,
+            messages=_refinement_messages(base_plan, request),
+            temperature=0 if DETERMINISTIC_MODE else 0.5,
+            max_tokens=300,
+            retry_truncated=False
+        )
+    except TruncatedCompletionError as e:
+        return e.content  # A summary missing its last bullet is still worth showing
+
+def classify_chat_intent(user_input: str) -> str:
+    """Classify a chat message as MODIFY (change the plan) or DISCUSS (ask about it)"""
+    try:
+        label = _completion(
+            model=REFINE_MODEL,
+            messages=[_CLASSIFY_MSG, {"role": "user", "content": user_input}],
+            temperature=0,
+            max_tokens=5,
+            retry_truncated=False
+        )
+    except TruncatedCompletionError as e:
+        label = e.content  # Only the label's first word matters
+    except Exception:
+        return "MODIFY"  # Fall back to refining, as before classification existed
+    return "DISCUSS" if "DISCUSS" in label.upper() else "MODIFY"
+
 def get_chat_response(conversation_history, user_input):
     """Get response from OpenAI for chat refinements"""
     try:
-        messages = [
-            {"role": "system", "content": "You are an expert educator helping to refine and improve lesson plans. Provide specific, actionable suggestions and be ready to modify the plan based on teacher requests."}
-        ] + conversation_history + [
+        messages = [_CHAT_SYSTEM_MSG] + conversation_history + [
             {"role": "user", "content": user_input}
         ]
         
-        response = client.chat.completions.create(
-            model="gpt-4-turbo-preview",
+        return _create_completion(
+            model=REFINE_MODEL,
             messages=messages,
             temperature=0.5,
             max_tokens=2000
         )
-        return response.choices[0].message.content
+    except TruncatedCompletionError as e:
+        return f"{e.content}\n\n*(Reply cut off at the length limit; ask me to continue.)*"
     except Exception as e:
         return f"Error getting response: {str(e)}"
 
+def _plan_chunks(plan: str) -> list:
+    """Split a plan just before each lesson heading into chunks that join back to it exactly.
+
+    The whitespace separating lessons starts the following chunk and trailing whitespace is
+    a chunk of its own, so a lesson's chunk is the same wherever it falls in the plan.
+    """
+    bounds = [len(plan[:match.start()].rstrip()) for match in _lesson_headings(plan)]
+    bounds = sorted({0, *bounds, len(plan.rstrip()), len(plan)})
+    return [plan[start:end] for start, end in zip(bounds, bounds[1:])]
+
+def _plan_message(plan: str) -> dict:
+    """Chat message referencing a plan version, storing each distinct lesson text once.
+
+    Lesson chunks are kept in st.session_state.plan_sections keyed by SHA-1, and each
+    version in st.session_state.plan_versions is just the list of its chunk hashes. A
+    refinement that rewrites one lesson therefore adds about one lesson of text, not a
+    whole plan, since every unchanged lesson is shared with earlier versions.
+    """
+    plan_hash = hashlib.sha1(plan.encode("utf-8")).hexdigest()
+    if plan_hash not in st.session_state.plan_versions:
+        chunk_hashes = []
+        for chunk in _plan_chunks(plan):
+            chunk_hash = hashlib.sha1(chunk.encode("utf-8")).hexdigest()
+            st.session_state.plan_sections.setdefault(chunk_hash, chunk)
+            chunk_hashes.append(chunk_hash)
+        st.session_state.plan_versions[plan_hash] = chunk_hashes
+    return {"role": "assistant", "plan_hash": plan_hash}
+
+def _message_content(message: dict) -> str:
+    """Text of a chat message, reassembling referenced plan versions from their chunks"""
+    if "plan_hash" in message:
+        chunk_hashes = st.session_state.plan_versions[message["plan_hash"]]
+        return "".join(st.session_state.plan_sections[chunk_hash] for chunk_hash in chunk_hashes)
+    return message["content"]
+
+@st.fragment
+def chat_interface():
+    """Chat, download and reset controls for an existing plan.
+
+    Runs as a fragment so sending a message only reruns this part of the page.
+    """
+    st.subheader("💬 Now you have your lesson plan!")
+    st.markdown("Ask questions  or request modifications at the bottom of the page to make changes to your lesson plan.")
+    
+    # Split the plan into lessons so refinements can patch individual lessons
+    if st.session_state.get("lesson_sections") is None:
+        st.session_state.lesson_sections = split_lesson_sections(st.session_state.generated_plan)
+    
+    # Ensure the generated plan is added to chat history
+    if not st.session_state.chat_history:
+        st.session_state.chat_history.append(_plan_message(st.session_state.generated_plan))
+    
+    # Display chat history
+    for message in st.session_state.chat_history:
+        with st.chat_message(message["role"]):
+            st.markdown(_message_content(message))
+    
+    # Chat input
+    if user_input := st.chat_input("Your message:"):
+        # Add user message to history and show it straight away
+        st.session_state.chat_history.append({"role": "user", "content": user_input})
+        with st.chat_message("user"):
+            st.markdown(user_input)
+        base_plan = st.session_state.generated_plan
+        
+        with st.chat_message("assistant"):
+            # Questions about the plan are answered directly without regenerating it
+            if classify_chat_intent(user_input) == "DISCUSS":
+                # The current plan is sent once, so leave earlier plan versions out of the context
+                recent_messages = [
+                    message for message in st.session_state.chat_history[-7:-1]
+                    if "plan_hash" not in message
+                ]
+                with st.spinner("💭 Thinking..."):
+                    reply = get_chat_response(
+                        [{"role": "assistant", "content": base_plan}] + recent_messages, user_input
+                    )
+                st.session_state.chat_history.append({"role": "assistant", "content": reply})
+                st.rerun(scope="fragment")
+            
+            # Refine lesson plan and summarise the changes concurrently. Plans split into
+            # lessons are refined as a patch of the changed lessons only.
+            sections = st.session_state.lesson_sections
+            if sections:
+                refine_future = _submit(refine_lesson_sections_with_openai(base_plan, user_input))
+            else:
+                refine_future = _submit(refine_lesson_plan_with_openai(base_plan, user_input))
+            summary_future = _submit(summarize_refinement(base_plan, user_input))
+            
+            with st.spinner("🔄 Refining the lesson plan..."):
+                # The summary is shorter, so show it while the refined plan is still generating
+                try:
+                    summary = summary_future.result()
+                    st.info(f"📝 Planned changes:\n\n{summary}")
+                except Exception:
+                    summary = None  # The summary is a nice-to-have; the refinement result is what matters
+                
+                try:
+                    refined_plan, suggestions = refine_future.result()
+                    if sections:
+                        refined_plan = join_lesson_sections(apply_lesson_patch(sections, refined_plan))
+                except Exception as e:
+                    st.error(f"Error refining lesson plan: {str(e)}")
+                    refined_plan = None
+            
+            if refined_plan:
+                # Add the change summary and refined plan to history
+                if summary:
+                    st.session_state.chat_history.append(
+                        {"role": "assistant", "content": f"📝 Planned changes:\n\n{summary}"}
+                    )
+                st.session_state.chat_history.append(_plan_message(refined_plan))
+                if suggestions:
+                    st.session_state.chat_history.append(
+                        {"role": "assistant", "content": f"💡 Suggested next improvements:\n\n{suggestions}"}
+                    )
+                
+                # Update the generated plan with the refined version
+                st.session_state.generated_plan = refined_plan
+                st.session_state.lesson_sections = split_lesson_sections(refined_plan)
+                
+                # Only the chat needs redrawing, not the whole page
+                st.rerun(scope="fragment")
+    
+    # Download button
+    st.download_button(
+        label="📥 Download Lesson Plan",
+        data=st.session_state.generated_plan,
+        file_name=f"lesson_plan_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt",
+        mime="text/markdown"
+    )
+    
+    if st.button("🔄 Create New Plan"):
+        st.session_state.generated_plan = None
+        st.session_state.lesson_sections = None
+        st.session_state.chat_history = []
+        st.session_state.plan_versions = {}
+        st.session_state.plan_sections = {}
+        st.rerun()  # Leaving the chat changes the whole page, so rerun the full app
+
 def main():
     # Configure page
     st.set_page_config(
@@ -116,47 +1532,22 @@ def main():
         initial_sidebar_state="expanded"
     )
 
-    # Custom CSS for dark theme (previous CSS remains the same)
-    st.markdown("""
-        <style>
-        /* Main container styling */
-        .stApp {
-            background-color: #0e1117;
-        }
-
-        
-        /* Chat container */
-        .chat-container {
-            background-color: #1a1c23;
-            padding: 1rem;
-            border-radius: 8px;
-            margin: 1rem 0;
-            border: 1px solid #2d3139;
-        }
-        
-        .chat-message {
-            padding: 1rem;
-            margin: 0.5rem 0;
-            border-radius: 8px;
-        }
-        
-        .user-message {
-            background-color: #2d3139;
-        }
-        
-        .assistant-message {
-            background-color: #1e222b;
-        }
-        
-        /* Rest of the CSS remains the same */
-        </style>
-    """, unsafe_allow_html=True)
+    # Custom CSS for dark theme
+    inject_css()
 
     # Initialize session state for chat
     if 'generated_plan' not in st.session_state:
         st.session_state.generated_plan = None
     if 'chat_history' not in st.session_state:
         st.session_state.chat_history = []
+    if 'plan_versions' not in st.session_state:
+        st.session_state.plan_versions = {}
+    if 'plan_sections' not in st.session_state:
+        st.session_state.plan_sections = {}
+    if 'pending_batch' not in st.session_state:
+        st.session_state.pending_batch = []
+    if 'batch_id' not in st.session_state:
+        st.session_state.batch_id = None
 
     # Main UI
     if not st.session_state.generated_plan:
@@ -164,17 +1555,18 @@ def main():
         col1, col2 = st.columns(2)
 
         with col1:
-            st.markdown('<div class="dark-container">', unsafe_allow_html=True)
-            st.subheader("📝 Lesson Requirements")
-            enquiry_question = st.text_area("Main enquiry question",
-                                          height=100,
-                                          placeholder="What is your main enquiry question?")
-            
-            st.subheader("📌 Adaptive Teaching")
-            adaptive_practices = st.text_area("Adaptive teaching practices",
-                                           height=100,
-                                           placeholder="Outline your adaptive teaching approaches...")
-            st.markdown('</div>', unsafe_allow_html=True)
+            with st.container(border=True):
+                st.subheader("📝 Lesson Requirements")
+                enquiry_question = st.text_area("Main enquiry question",
+                                              height=100,
+                                              placeholder="What is your main enquiry question?",
+                                              key="enquiry_question",
+                                              on_change=prefetch_embedding)
+                
+                st.subheader("📌 Adaptive Teaching")
+                adaptive_practices = st.text_area("Adaptive teaching practices",
+                                               height=100,
+                                               placeholder="Outline your adaptive teaching approaches...")
             
             st.subheader("👩‍🏫 Year Group")
             year_group = st.selectbox("Select year group:",
@@ -183,22 +1575,23 @@ def main():
             
 
         with col2:
-            st.markdown('<div class="dark-container">', unsafe_allow_html=True)
-            st.subheader("🎯 Learning Objectives")
-            objectives = st.text_area("Learning objectives",
-                                    height=100,
-                                    placeholder="Enter your learning objectives...")
+            with st.container(border=True):
+                st.subheader("🎯 Learning Objectives")
+                objectives = st.text_area("Learning objectives",
+                                        height=100,
+                                        placeholder="Enter your learning objectives...",
+                                        key="objectives",
+                                        on_change=prefetch_embedding)
             
-            st.subheader("🔄 Active Learning Activities")
-            active_learning = st.text_area("Active learning strategies",
-                                         height=100,
-                                         placeholder="Describe your active learning activities...")
+                st.subheader("🔄 Active Learning Activities")
+                active_learning = st.text_area("Active learning strategies",
+                                             height=100,
+                                             placeholder="Describe your active learning activities...")
             
             
             
-            st.subheader("📚 Number of Lessons")
-            num_lessons = st.slider("Number of lessons", 1, 10, 3)
-            st.markdown('</div>', unsafe_allow_html=True)
+                st.subheader("📚 Number of Lessons")
+                num_lessons = st.slider("Number of lessons", 1, 10, 3)
 
         if st.button("🚀 Generate Lesson Plan"):
             if not all([enquiry_question, objectives, active_learning, adaptive_practices]):
@@ -216,63 +1609,97 @@ def main():
                     
                     if generated_plan:
                         st.session_state.generated_plan = generated_plan
+                        if st.session_state.plan_notice:
+                            st.session_state.chat_history = [
+                                _plan_message(generated_plan),
+                                {"role": "assistant", "content": st.session_state.plan_notice}
+                            ]
                         st.success("✅ Lesson plan generated successfully!")
                         st.rerun()  # Rerun the app to update the UI
-                        
+        
+        # Overnight batch mode: queue several enquiries and submit them for half the price
+        with st.expander("🌙 Overnight batch (50% cheaper, ready within 24 hours)"):
+            st.markdown(f"{len(st.session_state.pending_batch)} lesson plan(s) queued.")
+            batch_col1, batch_col2, batch_col3 = st.columns(3)
+            
+            with batch_col1:
+                if st.button("➕ Add to batch"):
+                    if not all([enquiry_question, objectives, active_learning, adaptive_practices]):
+                        st.warning("⚠️ Please fill out all fields to add a lesson plan to the batch!")
+                    else:
+                        prompt = _lesson_plan_prompt(
+                            enquiry_question,
+                            year_group,
+                            num_lessons,
+                            objectives,
+                            active_learning,
+                            adaptive_practices
+                        )
+                        custom_id = f"plan-{len(st.session_state.pending_batch):03d}"
+                        st.session_state.pending_batch.append({
+                            "title": enquiry_question,
+                            "request": build_batch_request(custom_id, prompt, num_lessons)
+                        })
+                        st.rerun()
+            
+            with batch_col2:
+                if st.button("📤 Submit batch", key="queue_batch", disabled=not st.session_state.pending_batch):
+                    batch_id = submit_lesson_plan_batch(
+                        [item["request"] for item in st.session_state.pending_batch]
+                    )
+                    if batch_id:
+                        st.session_state.batch_id = batch_id
+                        st.session_state.batch_titles_id = batch_id
+                        st.session_state.batch_titles = {
+                            item["request"]["custom_id"]: item["title"]
+                            for item in st.session_state.pending_batch
+                        }
+                        # Kept with the cache TTL so a batch resumed from another session keeps its
+                        # titles; requests fall back to their custom ids once it has expired
+                        _cache_set(f"batch:{batch_id}", json.dumps(st.session_state.batch_titles))
+                        st.session_state.pending_batch = []
+                        st.success(f"✅ Batch submitted: {batch_id}")
+            
+            # The batch id lets a teacher come back for the results from a later session
+            if st.session_state.batch_id:
+                st.markdown(f"Current batch: `{st.session_state.batch_id}`")
+            resume_id = st.text_input("Resume a batch by id", placeholder="batch_...").strip()
+            
+            with batch_col3:
+                check_id = resume_id or st.session_state.batch_id
+                if st.button("🔍 Check batch", disabled=not check_id):
+                    status, plans, errors = retrieve_lesson_plan_batch(check_id)
+                    titles = _batch_titles(check_id)
+                    # A pasted id is checked without losing track of this session's own batch
+                    if status in BATCH_TERMINAL_STATUSES and check_id == st.session_state.batch_id:
+                        st.session_state.batch_id = None
+                    failures = "\n".join(
+                        f"- {titles.get(custom_id, custom_id)}: {error}" for custom_id, error in errors
+                    )
+                    if plans:
+                        plan = "\n\n---\n\n".join(
+                            f"# {titles.get(custom_id, custom_id)}\n\n{plans[custom_id]}"
+                            for custom_id in sorted(plans)
+                        )
+                        st.session_state.generated_plan = plan
+                        # The page reruns into the chat, so report failures there rather than here
+                        st.session_state.chat_history = [_plan_message(plan)]
+                        if errors:
+                            notice = f"⚠️ {len(errors)} batch request(s) had problems:\n\n{failures}"
+                            st.session_state.chat_history.append(
+                                {"role": "assistant", "content": notice}
+                            )
+                        st.rerun()
+                    elif errors:
+                        st.error(f"Batch {status} with no lesson plans:\n\n{failures}")
+                    elif status != "error":
+                        st.info(f"Batch status: {status}")
+
 
     else:
         # Display the chat interface
-        st.markdown('<div class="dark-container">', unsafe_allow_html=True)
-        st.subheader("💬 Now you have your lesson plan!")
-        st.markdown("Ask questions  or request modifications at the bottom of the page to make changes to your lesson plan.")
-        
-        # Ensure the generated plan is added to chat history
-        if not st.session_state.chat_history:
-            st.session_state.chat_history.append({"role": "assistant", "content": st.session_state.generated_plan})
-        
-        # Display chat history
-        for message in st.session_state.chat_history:
-            role = message["role"]
-            content = message["content"]
-            
-            if role == "user":
-                st.markdown(f'<div class="chat-message user-message">👤 You: {content}</div>', 
-                          unsafe_allow_html=True)
-            else:
-                st.markdown(f'<div class="chat-message assistant-message">🤖 Assistant: {content}</div>', 
-                          unsafe_allow_html=True)
-        
-        # Chat input
-        user_input = st.text_area("Your message:", key="chat_input", height=100)
-        if st.button("Send"):
-            if user_input:
-                # Add user message to history
-                st.session_state.chat_history.append({"role": "user", "content": user_input})
-                
-                # Refine lesson plan based on user input
-                refined_plan = refine_lesson_plan_with_openai(st.session_state.generated_plan, user_input)
-                
-                # Add refined plan to history
-                st.session_state.chat_history.append({"role": "assistant", "content": refined_plan})
-                
-                # Update the generated plan with the refined version
-                st.session_state.generated_plan = refined_plan
-                
-        
-        # Download button
-        st.download_button(
-            label="📥 Download Lesson Plan",
-            data=st.session_state.generated_plan,
-            file_name=f"lesson_plan_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt",
-            mime="text/markdown"
-        )
-        
-        if st.button("🔄 Create New Plan"):
-            st.session_state.generated_plan = None
-            st.session_state.chat_history = []
-            st.experimental_rerun()
-        
-        st.markdown('</div>', unsafe_allow_html=True)
+        with st.container(border=True):
+            chat_interface()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,9 +1,33 @@
+import asyncio
 import datetime
-from unittest.mock import patch
+import json
+import time
+from unittest.mock import AsyncMock, patch
+import httpx
+import numpy as np
+import pytest
 from streamlit.testing.v1 import AppTest
 from openai.types.chat import ChatCompletionMessage
 from openai.types.chat.chat_completion import ChatCompletion, Choice
 
+from Chatbot import (
+    CACHE_TTL_SECONDS,
+    _cache_get,
+    _cache_items,
+    _completion_cache_key,
+    _decode_semantic_entry,
+    _encode_semantic_entry,
+    _iter_sse_chunks,
+    _parse_batch_output,
+    _partition_entries,
+    _plan_chunks,
+    _send_with_retries,
+    apply_lesson_patch,
+    join_lesson_sections,
+    outline_lesson_plan,
+    split_lesson_sections,
+)
+
 
 # See https://github.com/openai/openai-python/issues/715#issuecomment-1809203346
 def create_chat_completion(response: str, role: str = "assistant") -> ChatCompletion:
@@ -54,3 +78,202 @@ def test_Langchain_Quickstart(langchain_llm):
     at.button[0].set_value(True).run()
     print(at)
     assert at.info[0].value == RESPONSE
+
+
+PLAN = """# Magnets
+
+## Lesson 1: What is a magnet?
+Explore magnets.
+
+### Lesson 1 resources
+Bar magnets.
+
+## Lesson 2: Magnetic materials
+Sort materials.
+
+## Lesson 3: Making a compass
+Float a needle."""
+
+
+def test_split_lesson_sections_keeps_sub_headings_in_their_lesson():
+    sections = split_lesson_sections(PLAN)
+    assert sorted(sections) == [0, 1, 2, 3]
+    assert sections[0] == "# Magnets"
+    assert sections[1].startswith("## Lesson 1: What is a magnet?")
+    assert "### Lesson 1 resources" in sections[1]
+    assert join_lesson_sections(sections) == PLAN
+
+
+def test_split_lesson_sections_with_empty_preamble():
+    plan = "## Lesson 1: A\nOne.\n\n## Lesson 2: B\nTwo."
+    sections = split_lesson_sections(plan)
+    assert sections[0] == ""
+    assert join_lesson_sections(sections) == plan
+
+
+def test_split_lesson_sections_needs_unique_lesson_headings():
+    assert split_lesson_sections("A plan without lesson headings") == {}
+    assert split_lesson_sections("## Lesson 1: A\n\n## Lesson 1: B") == {}
+
+
+def test_apply_lesson_patch_removal_renumbers_lessons():
+    merged = apply_lesson_patch(split_lesson_sections(PLAN), {2: None})
+    assert sorted(merged) == [0, 1, 2]
+    assert merged[2].startswith("## Lesson 2: Making a compass")
+    assert split_lesson_sections(join_lesson_sections(merged)) == merged
+
+
+def test_apply_lesson_patch_fixes_heading_that_does_not_match_its_key():
+    merged = apply_lesson_patch(split_lesson_sections(PLAN), {2: "## Lesson 3: Magnetic or not?\nTest."})
+    assert merged[2].startswith("## Lesson 2: Magnetic or not?")
+    # A duplicate "Lesson 3" heading would stop the next refinement from patching lessons
+    assert sorted(split_lesson_sections(join_lesson_sections(merged))) == [0, 1, 2, 3]
+
+
+def test_apply_lesson_patch_matches_the_original_heading_level():
+    revision = {2: "Here is the revised lesson.\n\n### Lesson 2: Magnets at home\n#### Activities\nHunt."}
+    merged = apply_lesson_patch(split_lesson_sections(PLAN), revision)
+    assert merged[2] == "## Lesson 2: Magnets at home\n### Activities\nHunt."
+    assert split_lesson_sections(join_lesson_sections(merged)) == merged
+
+
+def test_apply_lesson_patch_adds_missing_heading_and_appends_lessons():
+    sections = split_lesson_sections(PLAN)
+    merged = apply_lesson_patch(sections, {2: "Sort materials again.", 7: "## Lesson 7: Review\nQuiz."})
+    assert merged[2] == "## Lesson 2: Magnetic materials\n\nSort materials again."
+    assert merged[4] == "## Lesson 4: Review\nQuiz."
+    assert merged[1] == sections[1]
+
+
+def test_outline_lesson_plan_accepts_a_complete_outline():
+    outline = {"title": "Magnets", "lessons": [{"title": "A", "objective": "a"}, {"title": "B"}]}
+    with patch("Chatbot._acompletion", AsyncMock(return_value=json.dumps(outline))):
+        assert asyncio.run(outline_lesson_plan("prompt", 2)) == outline
+
+
+@pytest.mark.parametrize("outline", [
+    ["not", "an", "object"],
+    {"lessons": [{"title": "A"}]},
+    {"lessons": {"1": {"title": "A"}, "2": {"title": "B"}}},
+    {"lessons": [{"title": "A"}, "B"]},
+    {"lessons": [{"title": "A"}, {"objective": "no title"}]},
+    {"lessons": [{"title": "A"}, {"title": "  "}]},
+])
+def test_outline_lesson_plan_rejects_malformed_outlines(outline):
+    with patch("Chatbot._acompletion", AsyncMock(return_value=json.dumps(outline))):
+        with pytest.raises(ValueError):
+            asyncio.run(outline_lesson_plan("prompt", 2))
+
+
+def test_parse_batch_output():
+    lines = [
+        {"custom_id": "plan-000", "response": {"status_code": 200, "body": {
+            "choices": [{"message": {"content": "Plan A"}, "finish_reason": "stop"}]}}},
+        {"custom_id": "plan-001", "response": {"status_code": 200, "body": {
+            "choices": [{"message": {"content": "Plan B"}, "finish_reason": "length"}]}}},
+        {"custom_id": "plan-002", "response": {"status_code": 429, "body": {
+            "error": {"message": "Rate limit reached"}}}},
+        {"custom_id": "plan-003", "response": None, "error": {"code": "expired", "message": "Expired"}},
+    ]
+    plans, errors = _parse_batch_output("\n".join(json.dumps(line) for line in lines) + "\n")
+    assert plans == {"plan-000": "Plan A", "plan-001": "Plan B"}
+    assert [custom_id for custom_id, _ in errors] == ["plan-001", "plan-002", "plan-003"]
+    assert errors[1][1] == "Rate limit reached"
+    assert errors[2][1] == "Expired"
+
+
+def test_completion_cache_key():
+    messages = [{"role": "user", "content": "Plan a lesson"}]
+    key = _completion_cache_key("gpt-4o-mini", messages, 0, 500, None)
+    assert key.startswith("completion:")
+    reordered = [{"content": "Plan a lesson", "role": "user"}]
+    assert key == _completion_cache_key("gpt-4o-mini", reordered, 0, 500, None)
+    assert key != _completion_cache_key("gpt-4o-mini", messages, 0, 600, None)
+    assert key != _completion_cache_key("gpt-4o-mini", messages, 0, 500, {"type": "json_object"})
+
+
+def test_semantic_entry_round_trip():
+    vector = np.array([0.25, -1.5, 3.0], dtype=np.float32)
+    item = _encode_semantic_entry(1700000000.5, vector, "Plan ✏️")
+    created, embedding, plan = _decode_semantic_entry(item)
+    assert created == 1700000000.5
+    assert plan == "Plan ✏️"
+    assert embedding.dtype == np.float32
+    assert np.array_equal(embedding, vector)
+
+
+def test_partition_entries_drops_expired_and_oldest_entries():
+    now = time.time()
+    created = [now - CACHE_TTL_SECONDS - 1] + [now - 10 * index for index in range(600, 0, -1)]
+    embeddings = [np.full(2, index, dtype=np.float32) for index in range(len(created))]
+    plans = [f"plan {index}" for index in range(len(created))]
+    entry = _partition_entries(created, embeddings, plans)
+    assert len(entry["plans"]) == 500
+    assert entry["plans"][0] == "plan 101"
+    assert entry["plans"][-1] == "plan 600"
+    assert entry["embeddings"].shape == (500, 2)
+    assert _partition_entries([now - CACHE_TTL_SECONDS - 1], embeddings[:1], plans[:1]) is None
+
+
+@patch("Chatbot._persistent_cache", side_effect=PermissionError("/tmp/lesson_cache"))
+def test_cache_backend_that_fails_to_build_counts_as_a_miss(persistent_cache):
+    assert _cache_get("completion:abc") is None
+    assert _cache_items("semantic-entries:abc") == []
+
+
+@patch("time.sleep")
+def test_send_with_retries_honours_retry_after(sleep):
+    statuses = iter([429, 503, 200])
+
+    def handler(request):
+        return httpx.Response(next(statuses), headers={"retry-after": "2"})
+
+    with httpx.Client(transport=httpx.MockTransport(handler), base_url="https://api.test") as http:
+        response = _send_with_retries(lambda: http.post("/chat/completions"))
+    assert response.status_code == 200
+    assert [call.args[0] for call in sleep.call_args_list] == [2.0, 2.0]
+
+
+@patch("time.sleep")
+def test_send_with_retries_retries_transport_errors_then_gives_up(sleep):
+    attempts = []
+
+    def handler(request):
+        attempts.append(request)
+        raise httpx.ConnectError("connection refused", request=request)
+
+    with httpx.Client(transport=httpx.MockTransport(handler), base_url="https://api.test") as http:
+        with pytest.raises(httpx.ConnectError):
+            _send_with_retries(lambda: http.post("/embeddings"), max_retries=2)
+    assert len(attempts) == 3
+    assert sleep.call_count == 2
+
+
+def test_iter_sse_chunks():
+    lines = [
+        'data: {"choices": [{"delta": {"role": "assistant"}, "finish_reason": null}]}',
+        "",
+        'data: {"choices": [{"delta": {"content": "Hello"}, "finish_reason": null}]}',
+        'data: {"choices": [{"delta": {}, "finish_reason": "length"}]}',
+        'data: {"choices": []}',
+        "data: [DONE]",
+        'data: {"choices": [{"delta": {"content": "ignored"}}]}',
+    ]
+    assert list(_iter_sse_chunks(lines)) == [("", None), ("Hello", None), ("", "length")]
+
+
+def test_plan_chunks_join_back_exactly():
+    plan = PLAN + "\n"
+    chunks = _plan_chunks(plan)
+    assert "".join(chunks) == plan
+    assert len(chunks) == 5  # Preamble, three lessons and the trailing newline
+
+
+def test_plan_chunks_are_shared_between_versions():
+    sections = split_lesson_sections(PLAN)
+    revision = {2: "## Lesson 2: Sorting\nSort again."}
+    revised = join_lesson_sections(apply_lesson_patch(sections, revision))
+    original_chunks, revised_chunks = _plan_chunks(PLAN), _plan_chunks(revised)
+    assert "".join(revised_chunks) == revised
+    # Only the rewritten lesson's chunk differs
+    assert len(set(revised_chunks) - set(original_chunks)) == 1